@@ -18,6 +18,7 @@ class Algorithm:
         angle_adjustments: List[float] = field(default_factory=list)
         cost: float = float("inf")
         vertex: Vertex = None
+        correspondence: List[int] = field(default_factory=list)  # branch of the larger vertex matched with each adjusted branch
 
         def __str__(self) -> str:
             return f"Rotation: {degrees(self.rotation):.2f}, Angle adjustments: {", ".join([str(round(degrees(angle), 2)) for angle in self.angle_adjustments])}, Cost: {self.cost:.3f}"
@@ -73,6 +74,8 @@ class Algorithm:
         )  # extract subset vertex
         cost = self.loss(rotated_smaller_vertex, subset_larger_vertex, offset)
         if cost < self.output[-1].cost:
+            # `extract_branches` sorts the branches of the subset by angle
+            sorted_subset = sorted(subset, key=lambda i: larger_vertex[i].angle)
             new_output = self.Output(
                 global_rotation,
                 [
@@ -82,6 +85,9 @@ class Algorithm:
                     )
                 ],
                 cost,
+                correspondence=[
+                    sorted_subset[(i + offset) % len(subset)] for i in range(len(subset))
+                ],
             )
             new_output.convert_to_vertex(rotated_smaller_vertex, already_rotated=True)
             if not new_output.vertex.check_constraints():
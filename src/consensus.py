@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import copy
+from typing import List
+import numpy as np
+from numpy import pi as PI
+from vertex_optim import Vertex, Branch
+from algo import Algorithm
+from incremental import IncrementalAlgorithm
+
+
+class JointAlignment:
+    """Joint alignment of N vertices to a consensus vertex minimizing the summed `Loss`.
+
+    Each iteration aligns every vertex to the current consensus (rotation,
+    correspondence and angle adjustments, with the constraint checks of `Algorithm`),
+    then moves each consensus branch to the weighted median of the branches matched
+    with it within the threshold, which minimizes their summed `Loss` terms. The
+    costs of a vertex are computed and dropped within the iteration, so an iteration
+    is linear in N and its memory does not depend on N.
+    """
+
+    def __init__(
+        self,
+        threshold: float = PI / 3,
+        max_iterations: int = 10,
+        tolerance: float = 1e-6,
+    ) -> None:
+        self.threshold = threshold
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.consensus: Vertex = None
+        self.output: List[Algorithm.Output] = []
+        self.cost = float("inf")
+
+    def __initial_consensus(self, vertices: List[Vertex]) -> Vertex:
+        # the consensus has the largest degree so every vertex is rotated onto it
+        consensus = copy.deepcopy(max(vertices, key=len))
+        consensus.constraints = []
+        consensus.tesselation_compatibilities = None
+        return consensus
+
+    @staticmethod
+    def __weighted_median(values: List[float], weights: List[float]) -> float:
+        order = np.argsort(values)
+        cumulated_weights = np.cumsum(np.array(weights)[order])
+        return np.array(values)[order][
+            np.searchsorted(cumulated_weights, cumulated_weights[-1] / 2)
+        ]
+
+    def __update_consensus(
+        self, vertices: List[Vertex], outputs: List[Algorithm.Output]
+    ) -> None:
+        consensus_angles = np.array([branch.angle for branch in self.consensus.branches])
+        matched_angles: List[List[float]] = [[] for _ in range(len(self.consensus))]
+        matched_weights: List[List[float]] = [[] for _ in range(len(self.consensus))]
+        for vertex, output in zip(vertices, outputs):
+            if output.vertex is None:
+                continue
+            rotated_vertex = vertex.rotate(output.rotation)
+            for branch, j in zip(rotated_vertex.branches, output.correspondence):
+                # same (unwrapped) difference as `Loss`
+                diff = branch.angle - consensus_angles[j]
+                if abs(diff) <= self.threshold + 1e-6:
+                    matched_angles[j].append(diff)
+                    # the terms of a vertex are scaled by 1 / its degree
+                    matched_weights[j].append(1 / len(vertex))
+        for j, diffs in enumerate(matched_angles):
+            if not diffs:
+                continue
+            # the weighted median minimizes the summed terms of the matched branches
+            shift = self.__weighted_median(diffs, matched_weights[j])
+            if shift != 0:
+                self.consensus[j] = Branch(
+                    consensus_angles[j] + shift, self.consensus[j].length
+                )
+        self.consensus._sort()
+
+    def optimize_patterns(self, vertices: List[Vertex]) -> List[Algorithm.Output]:
+        """Align N vertices to a common consensus vertex.
+
+        Args:
+            vertices (List[Vertex]): Vertices to align.
+
+        Returns:
+            List[Algorithm.Output]: Alignment of each vertex on `self.consensus`, the
+            correspondence gives the consensus branch matched with each branch.
+        """
+        if not vertices:
+            self.consensus, self.output, self.cost = None, [], 0.0
+            return self.output
+        self.consensus = self.__initial_consensus(vertices)
+        self.output, self.cost = [], float("inf")
+        best_consensus = copy.deepcopy(self.consensus)
+        for _ in range(self.max_iterations):
+            # the whole consensus moves at each iteration: the costs of each vertex
+            # are recomputed and dropped rather than kept in a session per vertex
+            outputs = [
+                IncrementalAlgorithm(self.consensus, vertex, self.threshold)()[0]
+                for vertex in vertices
+            ]
+            # a vertex without valid alignment counts for the maximal loss
+            cost = sum(
+                output.cost if output.vertex is not None else len(vertex)
+                for vertex, output in zip(vertices, outputs)
+            )
+            if self.output and cost >= self.cost - self.tolerance:
+                break
+            self.output, self.cost = outputs, cost
+            best_consensus = copy.deepcopy(self.consensus)
+            self.__update_consensus(vertices, outputs)
+        self.consensus = best_consensus
+        return self.output
+
+    def __call__(self, vertices: List[Vertex]) -> List[Algorithm.Output]:
+        return self.optimize_patterns(vertices)
+
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(0)
+    base_angles = [PI / 4, PI / 2, 3 * PI / 4, 5 * PI / 4, 3 * PI / 2, 7 * PI / 4]
+    noise = 0.02
+    vertices = []
+    for degree in [6] * 10 + [5] * 10 + [4] * 10:
+        rotation = random.uniform(0, 2 * PI)
+        vertices.append(
+            Vertex(
+                [
+                    (angle + rotation + random.gauss(0, noise), 1)
+                    for angle in random.sample(base_angles, degree)
+                ],
+                None,
+                None,
+            )
+        )
+
+    def gaps(angles: List[float]) -> np.ndarray:
+        angles = np.sort(np.array(angles) % (2 * PI))
+        return np.diff(np.append(angles, angles[0] + 2 * PI))
+
+    # the consensus recovers the gaps of the base pattern up to a rotation
+    joint_alignment = JointAlignment(PI / 6)
+    joint_alignment(vertices)
+    consensus_gaps = gaps([branch.angle for branch in joint_alignment.consensus.branches])
+    base_gaps = gaps(base_angles)
+    error = min(
+        np.max(np.abs(np.roll(consensus_gaps, shift) - base_gaps))
+        for shift in range(len(base_gaps))
+    )
+    assert error < 5 * noise, (joint_alignment.consensus, error)
+
+    # more iterations never increase the summed cost
+    previous_cost = float("inf")
+    for max_iterations in range(1, 6):
+        joint_alignment = JointAlignment(PI / 6, max_iterations)
+        joint_alignment(vertices)
+        assert joint_alignment.cost <= previous_cost + 1e-9, (max_iterations, joint_alignment.cost)
+        previous_cost = joint_alignment.cost
+
+    assert JointAlignment(PI / 6)([]) == []
+    print("JointAlignment recovers the base pattern")
@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import copy
+from itertools import combinations
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from numpy import pi as PI
+from numpy import radians
+from vertex_optim import Vertex
+from algo import Algorithm
+from loss import Loss
+from utils import Utils
+
+
+class IncrementalAlgorithm:
+    """Alignment session of two vertices keeping the loss terms of every candidate
+    (rotation, subset, offset) of the last run, so that small edits of the vertices
+    only recompute the affected terms before re-ranking the top-k outputs.
+
+    The vertices are watched in place: edit them (`Vertex.__setitem__`,
+    `Vertex.append_branch`, constraints such as `Boundary` or `DiffAngle`...) then
+    call the session again. An edit of one branch costs O(360 * M) vectorized
+    operations, M = C(n, k) * k being the number of (subset, offset) candidates of a
+    degree k vertex against a degree n one (5544 for 12 against 6 branches). The
+    constraints are still checked one adjusted vertex at a time, so an edit moving
+    many adjusted vertices under a selective constraint (e.g. a `Symmetry`) is
+    bounded by these checks.
+    """
+
+    ROTATIONS = radians(np.arange(360))  # same discretization as `Algorithm`
+
+    def __init__(
+        self,
+        vertex1: Vertex,
+        vertex2: Vertex,
+        threshold: float = PI / 3,
+        number_of_output: int = 1,
+    ) -> None:
+        self.vertex1 = vertex1
+        self.vertex2 = vertex2
+        self.threshold = threshold
+        self.number_of_output = number_of_output
+        self.output = [Algorithm.Output() for _ in range(number_of_output)]
+        self.__rebuild()
+
+    def __angles(self, vertex: Vertex) -> np.ndarray:
+        return np.array([branch.angle for branch in vertex.branches], dtype=float)
+
+    def __lengths(self, vertex: Vertex) -> np.ndarray:
+        return np.array([branch.length for branch in vertex.branches], dtype=float)
+
+    def __rotated_offsets(self, smaller_angles: np.ndarray) -> np.ndarray:
+        # number of branches wrapping over 2 PI, i.e. the roll applied by `Vertex.rotate`
+        return np.sum(
+            smaller_angles[None, :] + self.ROTATIONS[:, None] >= 2 * PI - 1e-10, axis=1
+        )
+
+    def __compute_terms(
+        self, smaller_angles: np.ndarray, larger_angles: np.ndarray
+    ) -> np.ndarray:
+        """Loss terms between every rotated branch of the smaller vertex and the given
+        branches of the larger one, indexed by (smaller branch, larger branch, rotation).
+        """
+        rotated_angles = (smaller_angles[:, None] + self.ROTATIONS[None, :]) % (2 * PI)
+        return self.loss.terms(
+            rotated_angles[:, None, :],
+            larger_angles[None, :, None],
+            len(self._smaller_angles),
+        )
+
+    def __rows(self, rotations: np.ndarray) -> np.ndarray:
+        # branch of the smaller vertex at each position of the rotated one
+        k = len(self._smaller_angles)
+        return (np.arange(k)[None, :] - self._offsets[rotations, None]) % k
+
+    def __gather_costs(self, candidates: np.ndarray = None) -> np.ndarray:
+        """Costs indexed by (candidate, rotation), one row per candidate so that the
+        updates gather and scatter contiguous rows.
+        """
+        columns = self._columns if candidates is None else self._columns[candidates]
+        costs = self._terms[0][columns[:, 0]]
+        for i in range(1, len(self._smaller_angles)):
+            costs += self._terms[i][columns[:, i]]
+        return costs
+
+    def __build_candidates(self) -> None:
+        """Candidates as (subset, Q) with Q = (roll of the rotated vertex + offset) % k:
+        the cost of a candidate only depends on Q, so a roll of the rotated vertex
+        does not change the costs.
+        """
+        k, n = len(self._smaller_angles), len(self._larger_angles)
+        self._subsets = list(combinations(range(n), k))
+        subsets = np.array(self._subsets, dtype=int).reshape(-1, k)
+        # `Vertex.extract_branches` sorts the branches of each subset by angle
+        ranks = np.empty(n, dtype=int)
+        ranks[self._larger_order] = np.arange(n)
+        subsets = np.take_along_axis(subsets, np.argsort(ranks[subsets], axis=1), axis=1)
+        subsets = np.repeat(subsets, k, axis=0)
+        # larger branch matched with each branch of the smaller vertex
+        positions = (np.arange(k)[None, :] + np.tile(np.arange(k), len(self._subsets))[:, None]) % k
+        self._columns = np.take_along_axis(subsets, positions, axis=1)
+
+    def __matched_branches(self, indices: np.ndarray) -> np.ndarray:
+        # larger branch matched with each position of the rotated smaller vertex
+        candidates, rotations = np.divmod(indices, len(self.ROTATIONS))
+        return np.take_along_axis(
+            self._columns[candidates], self.__rows(rotations), axis=1
+        )
+
+    def __enumeration_order(self, indices: np.ndarray) -> np.ndarray:
+        # index of the candidate in the (rotation, subset, offset) order of `Algorithm`
+        k = len(self._smaller_angles)
+        candidates, rotations = np.divmod(indices, len(self.ROTATIONS))
+        Q = candidates % k
+        return (
+            rotations * self._columns.shape[0]
+            + candidates
+            - Q
+            + (Q - self._offsets[rotations]) % k
+        )
+
+    def __rebuild(self) -> None:
+        self.loss = Loss(self.threshold)
+        self._threshold = self.threshold
+        self._smaller, self._larger = Utils.detect_smaller_vertex(
+            self.vertex1, self.vertex2
+        )
+        self._smaller_angles = self.__angles(self._smaller)
+        self._smaller_lengths = self.__lengths(self._smaller)
+        self._larger_angles = self.__angles(self._larger)
+        self._larger_order = np.argsort(self._larger_angles, kind="stable")
+        self._constraints = copy.deepcopy(self._smaller.constraints)
+        self._offsets = self.__rotated_offsets(self._smaller_angles)
+        self._terms = self.__compute_terms(self._smaller_angles, self._larger_angles)
+        self.__build_candidates()
+        self._costs = self.__gather_costs()
+        self._bound = -np.inf  # cost of the last candidate ranked
+        # adjusted vertices checked against the constraints, by rotation, roll of the
+        # rotated vertex and adjusted angles
+        self._cache: Dict[Tuple[int, int, bytes], Optional[Vertex]] = {}
+
+    def __update_larger(self) -> None:
+        larger_angles = self.__angles(self._larger)
+        larger_order = np.argsort(larger_angles, kind="stable")
+        if len(larger_angles) == len(self._larger_angles):
+            for j in np.flatnonzero(larger_angles != self._larger_angles):
+                column = self.__compute_terms(
+                    self._smaller_angles, larger_angles[j : j + 1]
+                )[:, 0, :]
+                matched = self._columns == j
+                candidates = np.flatnonzero(matched.any(axis=1))
+                self._costs[candidates] += matched[candidates] @ (
+                    column - self._terms[:, j, :]
+                )
+                self._terms[:, j, :] = column
+                self._larger_angles[j] = larger_angles[j]
+            if not np.array_equal(larger_order, self._larger_order):
+                # `Vertex.__setitem__` does not sort: only the subsets holding a moved
+                # branch and a branch it crossed are matched in another order
+                previous_columns = self._columns
+                self._larger_order = larger_order
+                self.__build_candidates()
+                reordered = np.flatnonzero((self._columns != previous_columns).any(axis=1))
+                self._costs[reordered] = self.__gather_costs(reordered)
+            return
+        # branches were added or removed: the candidates change, the terms of the
+        # unchanged branches are reused
+        previous_columns: Dict[float, List[int]] = {}
+        for j, angle in enumerate(self._larger_angles):
+            previous_columns.setdefault(angle, []).append(j)
+        terms = np.empty((len(self._smaller_angles), len(larger_angles), len(self.ROTATIONS)))
+        for j, angle in enumerate(larger_angles):
+            if previous_columns.get(angle):
+                terms[:, j, :] = self._terms[:, previous_columns[angle].pop(0), :]
+            else:
+                terms[:, j, :] = self.__compute_terms(
+                    self._smaller_angles, larger_angles[j : j + 1]
+                )[:, 0, :]
+        self._larger_angles = larger_angles
+        self._larger_order = larger_order
+        self._terms = terms
+        self.__build_candidates()
+        self._costs = self.__gather_costs()
+
+    def __update_smaller(self) -> None:
+        smaller_lengths = self.__lengths(self._smaller)
+        if not np.array_equal(smaller_lengths, self._smaller_lengths):
+            self._smaller_lengths = smaller_lengths
+            self._cache = {}
+        smaller_angles = self.__angles(self._smaller)
+        changed = np.flatnonzero(smaller_angles != self._smaller_angles)
+        if len(changed) == 0:
+            return
+        # a roll of the rotated vertex keeps the costs, see `__build_candidates`
+        self._offsets = self.__rotated_offsets(smaller_angles)
+        for i in changed:
+            row = self.__compute_terms(smaller_angles[i : i + 1], self._larger_angles)[0]
+            # the term of a branch is only scaled by the degree of the smaller vertex,
+            # so editing a branch only changes its own row
+            self._costs += (row - self._terms[i])[self._columns[:, i]]
+            self._terms[i] = row
+        self._smaller_angles = smaller_angles
+
+    def __adjustments(
+        self, indices: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Angle adjustments of the rotated smaller vertex for the given candidates,
+        as computed by `Algorithm` from `Utils.distance_between_vertex`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Matched larger branches, Angle
+            adjustments, Adjusted angles.
+        """
+        rotations = indices % len(self.ROTATIONS)
+        rotated_angles = (
+            self._smaller_angles[None, :] + self.ROTATIONS[rotations, None]
+        ) % (2 * PI)
+        rotated_angles = np.take_along_axis(rotated_angles, self.__rows(rotations), axis=1)
+        matched = self.__matched_branches(indices)
+        adjustments = self._larger_angles[matched] - rotated_angles
+        adjustments[np.abs(adjustments) > self.threshold + 1e-6] = 0
+        return matched, adjustments, rotated_angles + adjustments
+
+    def __materialize(
+        self,
+        rotation: int,
+        adjustments: np.ndarray,
+        adjusted_angles: np.ndarray,
+        previous_cache: Dict[Tuple[int, int, bytes], Optional[Vertex]],
+    ) -> Optional[Vertex]:
+        # an edit that keeps the adjusted angles (e.g. a branch snapped on the same
+        # branch of the larger vertex) keeps the outcome of the constraint checks
+        key = (rotation, int(self._offsets[rotation]), adjusted_angles.tobytes())
+        if key in previous_cache:
+            self._cache[key] = previous_cache.pop(key)
+        if key not in self._cache:
+            output = Algorithm.Output(radians(rotation), adjustments.tolist())
+            vertex = output.convert_to_vertex(self._smaller)
+            self._cache[key] = vertex if vertex.check_constraints() else None
+        return self._cache[key]
+
+    def __ranked_candidates(self) -> Iterator[np.ndarray]:
+        """Chunks of candidates by increasing cost, ties broken in the enumeration
+        order of `Algorithm.optimize_pattern`.
+
+        The candidates are selected by cost bands: the first band reuses the cost
+        reached by the last ranking, which a small edit barely moves, so only this
+        part of the candidates is sorted. Further bands are taken by partition.
+        """
+        costs = self._costs.ravel()
+        size = min(costs.size, 64 * self.number_of_output)
+        if size == 0:
+            return
+        lower, upper = -np.inf, self._bound
+        while lower < np.inf:
+            if upper <= lower:
+                upper = np.partition(costs, size - 1)[size - 1]
+                size = min(costs.size, 2 * size)
+                if size == costs.size:
+                    upper = np.inf
+                if upper <= lower:
+                    continue
+            # the margin keeps the candidates tied up to the noise of the cost
+            # updates in the same band
+            selected = np.flatnonzero((costs > lower + 1e-9) & (costs <= upper + 1e-9))
+            rounded = np.round(costs[selected], 9)
+            selected = selected[np.lexsort((self.__enumeration_order(selected), rounded))]
+            for start in range(0, len(selected), 64 * self.number_of_output):
+                chunk = selected[start : start + 64 * self.number_of_output]
+                self._bound = costs[chunk[-1]]
+                yield chunk
+            lower = upper
+
+    def __rank(self) -> List[Algorithm.Output]:
+        outputs: List[Algorithm.Output] = []
+        # only the vertices checked by this ranking are kept, so the cache does not
+        # grow with the edits
+        previous_cache, self._cache = self._cache, {}
+        for indices in self.__ranked_candidates():
+            rotations = indices % len(self.ROTATIONS)
+            matched, adjustments, adjusted_angles = self.__adjustments(indices)
+            adjusted_angles = np.round(adjusted_angles, 9) + 0.0
+            # candidates giving the same adjusted vertex are only checked once, the
+            # first (cheapest) one of them is kept
+            keys = np.hstack([rotations[:, None].astype(float), adjusted_angles])
+            _, first = np.unique(keys, axis=0, return_index=True)
+            for i in np.sort(first):
+                vertex = self.__materialize(
+                    int(rotations[i]), adjustments[i], adjusted_angles[i], previous_cache
+                )
+                if vertex is None:
+                    continue
+                output = Algorithm.Output(
+                    radians(int(rotations[i])),
+                    adjustments[i].tolist(),
+                    float(self._costs.flat[indices[i]]),
+                    vertex,
+                    matched[i].tolist(),
+                )
+                if output.isInOutputList(outputs)[0]:
+                    continue
+                output.vertex = copy.deepcopy(vertex)  # the cached vertex is shared
+                outputs.append(output)
+                if len(outputs) == self.number_of_output:
+                    break
+            if len(outputs) == self.number_of_output:
+                break
+        self.output = outputs + [
+            Algorithm.Output() for _ in range(self.number_of_output - len(outputs))
+        ]
+        return self.output
+
+    def update(self) -> List[Algorithm.Output]:
+        """Recompute the terms affected by the edits since the last run and re-rank
+        the outputs.
+
+        Returns:
+            List[Algorithm.Output]: Best alignments, sorted by cost.
+        """
+        smaller, _ = Utils.detect_smaller_vertex(self.vertex1, self.vertex2)
+        if (
+            self.threshold != self._threshold
+            or smaller is not self._smaller
+            or len(smaller) != len(self._smaller_angles)
+        ):
+            # the degree of the smaller vertex scales every term
+            self.__rebuild()
+            return self.__rank()
+        self.__update_larger()
+        self.__update_smaller()
+        if self._smaller.constraints != self._constraints:
+            self._constraints = copy.deepcopy(self._smaller.constraints)
+            self._cache = {}
+        return self.__rank()
+
+    def __call__(self) -> List[Algorithm.Output]:
+        return self.update()
+
+
+if __name__ == "__main__":
+    # the session must give the same alignments as `Algorithm` after each edit
+    import random
+    from vertex_optim import Branch, DiffAngle
+
+    def check(session: IncrementalAlgorithm, edit: str) -> None:
+        expected = Algorithm(session.threshold, session.number_of_output)(
+            session.vertex1, session.vertex2
+        )
+        output = session()
+        for out, exp in zip(output, expected):
+            assert np.isclose(out.cost, exp.cost, rtol=0, atol=1e-9), (edit, output, expected)
+        assert output[0].correspondence == expected[0].correspondence, (edit, output, expected)
+
+    random.seed(0)
+    for _ in range(5):
+        larger = Vertex([(random.uniform(0, 2 * PI), 1) for _ in range(5)], None, None)
+        smaller = Vertex([(random.uniform(0, 2 * PI), 1) for _ in range(3)], None, None)
+        session = IncrementalAlgorithm(larger, smaller, PI / 6, 2)
+        check(session, "initial")
+        larger[random.randrange(5)] = Branch(random.uniform(0, 2 * PI), 1)
+        check(session, "larger __setitem__")
+        smaller[random.randrange(3)] = Branch(random.uniform(0, 2 * PI), 1)
+        check(session, "smaller __setitem__")
+        larger.append_branch(Branch(random.uniform(0, 2 * PI), 1))
+        check(session, "larger append_branch")
+        smaller.constraints.append(DiffAngle(0, 1, PI / 6, PI))
+        check(session, "DiffAngle added")
+        smaller.constraints[-1].max_diff = PI / 2
+        check(session, "DiffAngle changed")
+        smaller.append_branch(Branch(random.uniform(0, 2 * PI), 1))
+        check(session, "smaller append_branch")
+    print("IncrementalAlgorithm matches Algorithm")
@@ -1,3 +1,4 @@
+import numpy as np
 from vertex_optim import Vertex
 
 
@@ -27,3 +28,18 @@ class Loss:
             else:
                 self.loss += (diff / self.thereshold) * 1 / N
         return self.loss
+
+    def terms(self, angles1: np.ndarray, angles2: np.ndarray, N: int) -> np.ndarray:
+        """Vectorized per-branch terms of `compute`, summing them over the matched
+        branches gives the loss of the alignment.
+
+        Args:
+            angles1 (np.ndarray): Angles of the branches of the first vertex.
+            angles2 (np.ndarray): Angles of the matched branches of the second vertex (broadcastable).
+            N (int): Number of branches of the aligned vertices.
+
+        Returns:
+            np.ndarray: Loss term of each pair of branches.
+        """
+        diff = np.abs(angles1 - angles2)
+        return np.where(diff > self.thereshold + 1e-6, 1.0, (diff / self.thereshold) * 1 / N)